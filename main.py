@@ -1,23 +1,29 @@
 # ============================================================
 # main.py
 # Agri-bot — Open-Meteo primary, with OWM + OpenRouter fallback
-# Auto-loop cải tiến, monitor push, keep-alive thread
+# Auto-loop cải tiến, monitor push, keep-alive
 # ============================================================
 
 import os
+import math
 import time
-import json
+import random
 import logging
 import sqlite3
 import asyncio
-import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain, repeat
+from types import MappingProxyType
 from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, Any
 
-import requests
-from fastapi import FastAPI
-from pydantic import BaseModel
+import httpx
+import orjson
+from fastapi import FastAPI, Response
+from pydantic import BaseModel, ConfigDict
 
 # ---------------- Timezone ----------------
 try:
@@ -26,18 +32,43 @@ try:
 except Exception:
     LOCAL_TZ = None
 
+# ---------------- HTTP/2 (cần gói h2, cài qua httpx[http2]) ----------------
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except Exception:
+    HTTP2_ENABLED = False
+
 # ---------------- Cấu hình chung ----------------
 AUTO_LOOP_INTERVAL = int(os.getenv("AUTO_LOOP_INTERVAL", "600"))   # giây giữa các lần auto-push (mặc định 10 phút)
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "10"))          # timeout HTTP
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))                  # số lần thử lại khi lỗi tạm thời
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))              # backoff_factor: 0.3s, 0.6s, 1.2s...
+HTTP_RETRY_STATUSES = (429, 502, 503, 504)
+HTTP_RETRY_BUDGET = float(os.getenv("HTTP_RETRY_BUDGET", "20"))      # tổng thời gian tối đa cho mọi lần thử + chờ
+HTTP_CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", "1"))   # số lần transport thử kết nối lại
 DB_FILE = os.getenv("DB_FILE", "agri_bot.db")
+BIAS_FLUSH_BATCH = int(os.getenv("BIAS_FLUSH_BATCH", "64"))          # ghi DB ngay khi đủ N mẫu bias
+BIAS_FLUSH_INTERVAL = float(os.getenv("BIAS_FLUSH_INTERVAL", "5"))   # hoặc khi mẫu mới đến sau N giây kể từ lần ghi trước
+WEATHER_CACHE_FILE = os.getenv("WEATHER_CACHE_FILE", "weather_cache.json")  # snapshot cache khi restart
+LOCATION_NAME = os.getenv("LOCATION_NAME", "Dĩ An, Bình Dương")
 LAT = float(os.getenv("LAT", "10.9758"))     # Dĩ An, Bình Dương
 LON = float(os.getenv("LON", "106.8026"))
 EXTENDED_HOURS = 4  # hour_1..hour_4
+WEATHER_CACHE_SECONDS = int(os.getenv("WEATHER_CACHE_SECONDS", "900"))  # TTL cache dự báo (mặc định 15 phút)
+WEATHER_BREAKER_THRESHOLD = int(os.getenv("WEATHER_BREAKER_THRESHOLD", "3"))  # số lần lỗi Open-Meteo liên tiếp trước khi ngắt
+WEATHER_RETRY_COOLDOWN = float(os.getenv("WEATHER_RETRY_COOLDOWN", "60"))  # nghỉ khi ngắt, tăng gấp đôi mỗi lần lỗi tiếp theo
 
 # ---------------- ThingsBoard ----------------
 _raw_token = (os.getenv("TB_DEMO_TOKEN") or os.getenv("TB_TOKEN") or os.getenv("TB_DEVICE_TOKEN") or "").strip()
 TB_HOST = (os.getenv("TB_HOST") or os.getenv("TB_URL") or "https://thingsboard.cloud").strip().rstrip("/")
 TB_DEVICE_URL = f"{TB_HOST}/api/v1/{_raw_token}/telemetry" if _raw_token else None
+TB_BATCH_SIZE = int(os.getenv("TB_BATCH_SIZE", "10"))            # flush ngay khi đủ N mẫu
+TB_FLUSH_INTERVAL = float(os.getenv("TB_FLUSH_INTERVAL", "5"))    # hoặc sau mỗi N giây
+TB_BUFFER_MAX = int(os.getenv("TB_BUFFER_MAX", "200"))
+TB_BREAKER_THRESHOLD = int(os.getenv("TB_BREAKER_THRESHOLD", "3"))       # số lần lỗi liên tiếp trước khi ngắt
+TB_BREAKER_COOLDOWN = float(os.getenv("TB_BREAKER_COOLDOWN", "60"))      # giây tạm ngừng gửi khi ngắt
+TB_BREAKER_MAX_COOLDOWN = float(os.getenv("TB_BREAKER_MAX_COOLDOWN", "900"))  # trần cooldown khi lỗi kéo dài
 
 # ---------------- Fallback keys ----------------
 OWM_API_KEY = os.getenv("OWM_API_KEY")
@@ -58,18 +89,66 @@ def _mask_token(t: str) -> str:
         return t[:2] + "***"
     return t[:4] + "..." + t[-4:]
 
-logger.info(f"[ENV] TB_HOST={TB_HOST}")
-logger.info(f"[ENV] TB_TOKEN={_mask_token(_raw_token)} (len={len(_raw_token)})")
-logger.info(f"[ENV] TB_DEVICE_URL present = {bool(TB_DEVICE_URL)}")
-logger.info(f"[ENV] OWM_API_KEY present = {bool(OWM_API_KEY)}")
-logger.info(f"[ENV] OPENROUTER_API_KEY present = {bool(OPENROUTER_API_KEY)}")
-logger.info(f"[ENV] AUTO_LOOP_INTERVAL={AUTO_LOOP_INTERVAL}s")
-logger.info(f"[ENV] SELF_URL={SELF_URL} KEEPALIVE_INTERVAL={KEEPALIVE_INTERVAL}s")
+logger.info("[ENV] TB_HOST=%s", TB_HOST)
+logger.info("[ENV] TB_TOKEN=%s (len=%s)", _mask_token(_raw_token), len(_raw_token))
+logger.info("[ENV] TB_DEVICE_URL present = %s", bool(TB_DEVICE_URL))
+logger.info("[ENV] OWM_API_KEY present = %s", bool(OWM_API_KEY))
+logger.info("[ENV] OPENROUTER_API_KEY present = %s", bool(OPENROUTER_API_KEY))
+logger.info("[ENV] AUTO_LOOP_INTERVAL=%ss", AUTO_LOOP_INTERVAL)
+logger.info("[ENV] SELF_URL=%s KEEPALIVE_INTERVAL=%ss", SELF_URL, KEEPALIVE_INTERVAL)
+logger.info("[ENV] HTTP2_ENABLED=%s", HTTP2_ENABLED)
+
+# ---------------- HTTP client ----------------
+# Client async dùng chung cho mọi request ra ngoài: Open-Meteo, ThingsBoard, keep-alive (một connection pool).
+# Transport tự thử lại khi lỗi kết nối; lỗi HTTP tạm thời do _request_with_retry xử lý.
+# Tạo mới trong on_startup và đóng trong on_shutdown: mỗi lifespan của app có client riêng.
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=HTTP2_ENABLED,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            retries=HTTP_CONNECT_RETRIES,
+        ),
+        timeout=REQUEST_TIMEOUT,
+        headers={"User-Agent": "agri-bot/1.0"},
+    )
+
+async def _request_with_retry(method: str, url: str, **kwargs) -> httpx.Response:
+    # Một deadline chung cho cả chuỗi thử lại: mỗi lần gọi bị cắt theo thời gian còn lại,
+    # và không ngủ chờ thử lại nếu sau khi ngủ đã quá deadline
+    deadline = time.monotonic() + HTTP_RETRY_BUDGET
+    r: Optional[httpx.Response] = None
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            r = await asyncio.wait_for(
+                HTTP_CLIENT.request(method, url, **kwargs),
+                timeout=max(0.0, deadline - time.monotonic()),
+            )
+        except asyncio.TimeoutError:
+            if r is None:
+                raise
+            return r   # lần thử lại bị cắt ở deadline: trả về response lỗi trước đó
+        if r.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+            return r
+        # Backoff mũ có jitter: các caller cùng gặp 429/503 không thử lại đồng loạt
+        delay = HTTP_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+        retry_after = r.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        delay = min(delay, REQUEST_TIMEOUT)
+        if time.monotonic() + delay >= deadline:
+            return r
+        # Chỉ log host: URL của TB chứa token thiết bị
+        logger.warning("%s %s returned %s, retrying in %.1fs", method, r.url.host, r.status_code, delay)
+        await asyncio.sleep(delay)
+    return r
 
 # ============================================================
 # WEATHER CODE -> Tiếng Việt
 # ============================================================
-WEATHER_CODE_MAP = {
+WEATHER_CODE_MAP = MappingProxyType({
     0: "Trời nắng đẹp",
     1: "Trời không mây",
     2: "Trời có mây",
@@ -88,17 +167,26 @@ WEATHER_CODE_MAP = {
     95: "Có giông nhẹ",
     96: "Có giông vừa",
     99: "Có giông lớn",
-}
+})
 
 # ============================================================
 # DB: lưu lịch sử bias
 # ============================================================
 
+# Kết nối SQLite dùng chung, mở một lần trong init_db (WAL) thay cho connect/close mỗi lần ghi
+_db_conn: Optional[sqlite3.Connection] = None
+# Mẫu bias chờ ghi: gom lại rồi ghi theo lô trong một transaction (maxlen giới hạn bộ nhớ khi DB lỗi)
+_bias_pending: deque[tuple] = deque(maxlen=1000)
+_bias_last_flush = 0.0
+
 def init_db():
+    global _db_conn
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute(
+        _db_conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False, isolation_level=None)
+        _db_conn.execute("PRAGMA journal_mode=WAL")
+        _db_conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn.execute("PRAGMA temp_store=MEMORY")
+        _db_conn.execute(
             """
             CREATE TABLE IF NOT EXISTS bias_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -109,61 +197,171 @@ def init_db():
             )
             """
         )
-        conn.commit()
     except Exception as e:
-        logger.warning(f"init_db error: {e}")
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        logger.warning("init_db error: %s", e)
+
+def close_db():
+    global _db_conn
+    if _db_conn is None:
+        return
+    try:
+        # SQLite khuyến nghị chạy PRAGMA optimize trước khi đóng kết nối sống lâu
+        _db_conn.execute("PRAGMA optimize")
+        _db_conn.close()
+    except Exception as e:
+        logger.warning("close_db error: %s", e)
+    _db_conn = None
 
 def insert_history_to_db(api_temp: Optional[float], observed_temp: Optional[float], provider="open-meteo"):
+    # Gom mẫu và ghi theo lô ngay tại đây (đủ BIAS_FLUSH_BATCH mẫu hoặc đã quá BIAS_FLUSH_INTERVAL);
+    # phần còn lại được ghi khi shutdown. Không cần task nền thức dậy định kỳ khi không có mẫu nào.
+    # Caller đã ép kiểu float sẵn (dùng chung cho ring buffer), ở đây không ép lại
+    _bias_pending.append((api_temp, observed_temp, int(time.time()), provider))
+    if len(_bias_pending) >= BIAS_FLUSH_BATCH or time.monotonic() - _bias_last_flush >= BIAS_FLUSH_INTERVAL:
+        flush_bias_history()
+
+def flush_bias_history():
+    global _bias_last_flush
+    if not _bias_pending or _db_conn is None:
+        return
+    _bias_last_flush = time.monotonic()
+    rows = list(_bias_pending)
+    _bias_pending.clear()
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
-        cur = conn.cursor()
-        cur.execute(
+        _db_conn.execute("BEGIN")
+        _db_conn.executemany(
             "INSERT INTO bias_history (api_temp, observed_temp, ts, provider) VALUES (?, ?, ?, ?)",
-            (
-                None if api_temp is None else float(api_temp),
-                None if observed_temp is None else float(observed_temp),
-                int(time.time()),
-                provider,
-            ),
+            rows,
         )
-        conn.commit()
+        _db_conn.execute("COMMIT")
     except Exception as e:
-        logger.warning(f"insert_history_to_db error: {e}")
-    finally:
+        logger.warning("flush_bias_history error: %s", e)
         try:
-            conn.close()
+            _db_conn.execute("ROLLBACK")
         except Exception:
             pass
+        # Trả lô lại đầu hàng đợi để lần flush sau ghi lại; chỉ phần vừa chỗ trống
+        # (extendleft trên deque đầy sẽ đẩy mẫu mới nhất ra), bỏ các mẫu cũ nhất
+        room = _bias_pending.maxlen - len(_bias_pending)
+        if room > 0:
+            _bias_pending.extendleft(reversed(rows[-room:]))
+
+class BiasHistory:
+    # Ring buffer dạng SoA: hai mảng double liền kề (api, obs) thay cho deque các tuple.
+    # None được lưu thành NaN và bị bỏ qua khi tính bias.
+    # Tổng/số lượng diff hợp lệ được cập nhật dần khi append/ghi đè nên mean_diff là O(1).
+    def __init__(self, maxlen: int):
+        self.maxlen = max(1, maxlen)
+        self.api = array("d", [math.nan]) * self.maxlen
+        self.obs = array("d", [math.nan]) * self.maxlen
+        self.head = 0
+        self.size = 0
+        self.diff_sum = 0.0
+        self.diff_count = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, api: Optional[float], obs: Optional[float]):
+        i = self.head
+        old = self.obs[i] - self.api[i]
+        if old == old:  # ô bị ghi đè còn diff hợp lệ: trừ khỏi tổng
+            self.diff_sum -= old
+            self.diff_count -= 1
+        self.api[i] = math.nan if api is None else api
+        self.obs[i] = math.nan if obs is None else obs
+        d = self.obs[i] - self.api[i]
+        if d == d:
+            self.diff_sum += d
+            self.diff_count += 1
+        self.head = (i + 1) % self.maxlen
+        if self.size < self.maxlen:
+            self.size += 1
+        if self.head == 0:
+            # Mỗi vòng ring tính lại tổng từ đầu để sai số float cộng/trừ không tích luỹ mãi
+            self._resync()
+
+    def _resync(self):
+        total = 0.0
+        n = 0
+        for a, o in zip(self.api, self.obs):
+            d = o - a
+            if d == d:  # bỏ NaN (ô trống hoặc thiếu api/obs)
+                total += d
+                n += 1
+        self.diff_sum = total
+        self.diff_count = n
+
+    def mean_diff(self) -> Optional[float]:
+        return self.diff_sum / self.diff_count if self.diff_count else None
+
+bias_history = BiasHistory(int(os.getenv("BIAS_MAX_HISTORY", "48")))
+
+def load_history_from_db():
+    # Nạp lại các mẫu bias gần nhất từ SQLite để bias không phải "làm nóng" lại sau mỗi lần restart
+    if _db_conn is None:
+        return
+    try:
+        # SQLite trả về N dòng mới nhất theo đúng thứ tự cũ -> mới, không cần đảo list phía Python
+        rows = _db_conn.execute(
+            "SELECT api_temp, observed_temp FROM ("
+            " SELECT id, api_temp, observed_temp FROM bias_history ORDER BY id DESC LIMIT ?"
+            ") ORDER BY id ASC",
+            (bias_history.maxlen,),
+        ).fetchall()
+        for api, obs in rows:
+            bias_history.append(api, obs)
+        logger.info("Loaded %s bias samples from DB", len(rows))
+    except Exception as e:
+        logger.warning("load_history_from_db error: %s", e)
+
+# ============================================================
+# Dữ liệu dự báo theo giờ
+# ============================================================
 
-bias_history: deque[tuple[Optional[float], Optional[float]]] = deque(maxlen=int(os.getenv("BIAS_MAX_HISTORY", "48")))
+@dataclass(slots=True)
+class HourForecast:
+    # __slots__: truy cập thuộc tính nhanh hơn dict.get và mỗi giờ tốn ít bộ nhớ hơn
+    time: Optional[str]
+    label: Optional[str]   # "HH:MM" tính sẵn lúc parse, merge không phải cắt/parse lại
+    temperature: Optional[float]
+    humidity: Optional[float]
+    weather_code: Optional[int]
+    weather_short: Optional[str]
+    weather_desc: Optional[str]
+    precipitation: Optional[float]
+    precipitation_probability: Optional[float]
+    windspeed: Optional[float]
+    winddir: Optional[float]
 
 # ============================================================
 # Tiện ích thời gian
 # ============================================================
 
-def _now_local() -> datetime:
-    return datetime.now(LOCAL_TZ) if LOCAL_TZ else datetime.now()
+# LOCAL_TZ đã được dựng một lần lúc import; chọn sẵn nhánh để mỗi lần gọi không phải kiểm tra lại
+if LOCAL_TZ:
+    def _now_local() -> datetime:
+        return datetime.now(LOCAL_TZ)
+else:
+    def _now_local() -> datetime:
+        return datetime.now()
 
 def _to_local_dt(timestr: Optional[str]) -> Optional[datetime]:
     if not timestr:
         return None
     dt: Optional[datetime] = None
-    for fmt in ("%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S"):
-        try:
-            dt = datetime.strptime(timestr, fmt)
-            break
-        except Exception:
-            continue
+    # fromisoformat (C) xử lý được cả 3 định dạng bên dưới; strptime chỉ còn là fallback
+    try:
+        dt = datetime.fromisoformat(timestr)
+    except Exception:
+        for fmt in ("%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                dt = datetime.strptime(timestr, fmt)
+                break
+            except Exception:
+                continue
     if dt is None:
-        try:
-            dt = datetime.fromisoformat(timestr)
-        except Exception:
-            return None
+        return None
     if dt.tzinfo is None and LOCAL_TZ:
         dt = dt.replace(tzinfo=LOCAL_TZ)
     return dt
@@ -173,34 +371,183 @@ def ceil_to_next_hour(dt: datetime) -> datetime:
         return dt
     return dt.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
 
+def _hour_label(timestr: Optional[str]) -> Optional[str]:
+    # "YYYY-MM-DDTHH:MM..." -> "HH:MM" bằng cắt chuỗi, không cần parse datetime
+    if timestr and len(timestr) >= 16 and timestr[10] in "T " and timestr[13] == ":":
+        return timestr[11:16]
+    dt_local = _to_local_dt(timestr)
+    return dt_local.strftime("%H:%M") if dt_local else timestr
+
+def _hour_key(h: HourForecast) -> str:
+    # "YYYY-MM-DDTHH:MM" — chuỗi ISO-8601 giờ địa phương so sánh theo thứ tự từ điển = theo thời gian
+    return (h.time or "").replace(" ", "T")[:16]
+
+def _lookup_day(daily_list: list[dict], date_iso: str, hint: int) -> dict:
+    # daily_list bắt đầu từ hôm nay: thử vị trí dự kiến trước (O(1)), sau đó bisect theo ngày
+    if hint < len(daily_list) and daily_list[hint].get("date") == date_iso:
+        return daily_list[hint]
+    i = bisect_left(daily_list, date_iso, key=lambda d: d.get("date") or "")
+    if i < len(daily_list) and daily_list[i].get("date") == date_iso:
+        return daily_list[i]
+    return {}
+
+def _find_hour_index(hourly_list: list[HourForecast], start_time: datetime) -> int:
+    # hourly_list đã sắp xếp theo thời gian: bisect O(log n), không parse datetime
+    i = bisect_left(hourly_list, start_time.strftime("%Y-%m-%dT%H:%M"), key=_hour_key)
+    return i if i < len(hourly_list) else 0
+
 # ============================================================
 # Fetchers: Open-Meteo, OWM, OpenRouter
 # ============================================================
 
-def fetch_open_meteo() -> tuple[list[dict], list[dict], dict]:
-    base = "https://api.open-meteo.com/v1/forecast"
-    daily_vars = "weathercode,temperature_2m_max,temperature_2m_min,precipitation_sum"
-    hourly_vars = "temperature_2m,relativehumidity_2m,weathercode,precipitation,precipitation_probability,windspeed_10m,winddirection_10m"
-
-    params = {
-        "latitude": LAT,
-        "longitude": LON,
-        "daily": daily_vars,
-        "hourly": hourly_vars,
-        "timezone": "auto",
-        "timeformat": "iso8601",
-        "past_days": 1,
-        "forecast_days": 3,
-    }
+# Cache kết quả Open-Meteo theo (LAT, LON); dữ liệu cũ được dùng lại khi fetch lỗi
+_weather_cache: dict[tuple[float, float], dict[str, Any]] = {}
+# Tăng khi cấu trúc entry cache thay đổi để bỏ qua snapshot cũ không tương thích
+_WEATHER_SNAPSHOT_VERSION = 4
+
+def save_weather_cache():
+    # Snapshot dạng JSON (orjson tự serialize dataclass HourForecast), không dùng pickle:
+    # nạp lại file không bao giờ thực thi code. Ghi ra file tạm rồi os.replace để crash giữa chừng
+    # không để lại snapshot hỏng.
+    entries = [
+        {"lat": lat, "lon": lon, **entry}
+        for (lat, lon), entry in _weather_cache.items()
+    ]
+    tmp = WEATHER_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps({"version": _WEATHER_SNAPSHOT_VERSION, "entries": entries}))
+        os.replace(tmp, WEATHER_CACHE_FILE)
+    except Exception as e:
+        logger.warning("save_weather_cache error: %s", e)
+
+def load_weather_cache():
+    # Khởi động "ấm": dùng lại snapshot nếu còn; entry hết hạn vẫn giữ để làm fallback/ETag
+    try:
+        with open(WEATHER_CACHE_FILE, "rb") as f:
+            snapshot = orjson.loads(f.read())
+        if not isinstance(snapshot, dict) or snapshot.get("version") != _WEATHER_SNAPSHOT_VERSION:
+            logger.info("Ignoring incompatible weather cache snapshot")
+            return
+        for e in snapshot["entries"]:
+            daily_list, hourly_rows, raw = e["data"]
+            _weather_cache[(e["lat"], e["lon"])] = {
+                "ts": e["ts"],
+                "expires": e["expires"],
+                "etag": e.get("etag"),
+                "data": (daily_list, [HourForecast(**row) for row in hourly_rows], raw),
+            }
+        logger.info("Loaded weather cache snapshot (%s entries)", len(_weather_cache))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("load_weather_cache error: %s", e)
+
+# Single-flight: các lời gọi trùng lúc cache hết hạn cùng chờ một request đang bay
+_weather_inflight: dict[tuple[float, float], asyncio.Task] = {}
+# Circuit breaker: sau WEATHER_BREAKER_THRESHOLD lần lỗi liên tiếp, trả ngay dữ liệu cũ (hoặc rỗng) tới thời điểm này
+_weather_fail_count = 0
+_weather_open_until = 0.0
+
+async def fetch_open_meteo() -> tuple[list[dict], list[HourForecast], dict]:
+    key = (LAT, LON)
+    entry = _weather_cache.get(key)
+    now = time.time()
+    if entry and now < entry["expires"]:
+        return entry["data"]
+    if now < _weather_open_until:
+        return entry["data"] if entry else ([], [], {})
+
+    task = _weather_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_refresh_open_meteo(key, entry))
+        _weather_inflight[key] = task
+        task.add_done_callback(lambda _t: _weather_inflight.pop(key, None))
+    # shield: một caller bị huỷ không làm huỷ request dùng chung
+    return await asyncio.shield(task)
+
+def _cache_ttl(headers: httpx.Headers) -> float:
+    # Tôn trọng Cache-Control: max-age của upstream nhưng không vượt WEATHER_CACHE_SECONDS
+    # và không dưới 60s; thiếu header thì dùng WEATHER_CACHE_SECONDS
+    ttl = float(WEATHER_CACHE_SECONDS)
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            ttl = max(60.0, min(ttl, float(value)))
+    # TTL dao động ±10% để các lần hết hạn không dồn vào cùng một thời điểm
+    return ttl * random.uniform(0.9, 1.1)
+
+async def _refresh_open_meteo(key: tuple[float, float], entry: Optional[dict]) -> tuple[list[dict], list[HourForecast], dict]:
+    global _weather_fail_count, _weather_open_until
+    etag = entry.get("etag") if entry else None
+    r = await _request_open_meteo(etag)
+    if r is not None and r.status_code == 304 and entry:
+        # 304 Not Modified: giữ nguyên dữ liệu (và identity của nó), chỉ gia hạn TTL
+        result = entry["data"]
+    else:
+        result = _parse_open_meteo(r) if r is not None else ([], [], {})
+    if result[1]:
+        _weather_fail_count = 0
+        now = time.time()
+        _weather_cache[key] = {
+            "ts": now,
+            "expires": now + _cache_ttl(r.headers),
+            "etag": r.headers.get("ETag") or etag,
+            "data": result,
+        }
+        return result
+    _weather_fail_count += 1
+    if _weather_fail_count >= WEATHER_BREAKER_THRESHOLD:
+        # Giới hạn số mũ để 2**n không gây OverflowError khi Open-Meteo lỗi kéo dài
+        cooldown = min(WEATHER_RETRY_COOLDOWN * 2 ** min(_weather_fail_count - WEATHER_BREAKER_THRESHOLD, 5), WEATHER_CACHE_SECONDS)
+        cooldown *= random.uniform(0.8, 1.2)
+        _weather_open_until = time.time() + cooldown
+        logger.warning("[WEATHER] %s consecutive failures, pausing Open-Meteo fetches for %.0fs", _weather_fail_count, cooldown)
+    if entry:
+        logger.warning("Open-Meteo unavailable, serving cached data from %s", datetime.fromtimestamp(entry["ts"]).isoformat())
+        return entry["data"]
+    return result
+
+# Tham số Open-Meteo đều cố định theo LAT/LON: dựng một lần lúc import, mỗi lần fetch dùng lại
+_OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+_OPEN_METEO_DAILY = "weathercode,temperature_2m_max,temperature_2m_min,precipitation_sum"
+_OPEN_METEO_HOURLY = "temperature_2m,relativehumidity_2m,weathercode,precipitation,precipitation_probability,windspeed_10m,winddirection_10m"
+_OPEN_METEO_PARAMS = MappingProxyType({
+    "latitude": LAT,
+    "longitude": LON,
+    "daily": _OPEN_METEO_DAILY,
+    "hourly": _OPEN_METEO_HOURLY,
+    "timezone": "auto",
+    "timeformat": "iso8601",
+    "forecast_days": 3,
+})
+
+async def _request_open_meteo(etag: Optional[str] = None) -> Optional[httpx.Response]:
+    try:
+        r = await _request_with_retry(
+            "GET", _OPEN_METEO_URL, params=_OPEN_METEO_PARAMS, headers={"If-None-Match": etag} if etag else None
+        )
+        if r.status_code != 304:
+            r.raise_for_status()
+        return r
+    except Exception as e:
+        logger.error("Open-Meteo fetch error: %s", e)
+        return None
 
+def _parse_open_meteo(r: httpx.Response) -> tuple[list[dict], list[HourForecast], dict]:
     try:
-        r = requests.get(base, params=params, timeout=REQUEST_TIMEOUT)
-        r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
     except Exception as e:
-        logger.error(f"Open-Meteo fetch error: {e}")
+        logger.error("Open-Meteo decode error: %s", e)
         return [], [], {}
 
+    # Alias cục bộ cho lookup mã thời tiết (None không có trong map nên trả về None)
+    code_desc = WEATHER_CODE_MAP.get
+    hour_label = _hour_label
+    # Mảng ngắn hơn mảng time được đệm None, thay cho kiểm tra i < len(...) ở mỗi dòng
+    def pad(arr: list):
+        return chain(arr, repeat(None))
+
     daily_list: list[dict] = []
     d = data.get("daily", {})
     times = d.get("time", []) or []
@@ -209,18 +556,16 @@ def fetch_open_meteo() -> tuple[list[dict], list[dict], dict]:
     tmin = d.get("temperature_2m_min", []) or []
     psum = d.get("precipitation_sum", []) or []
 
-    for i, date in enumerate(times):
-        code = wc[i] if i < len(wc) else None
-        desc = WEATHER_CODE_MAP.get(code) if code is not None else None
+    for date, code, hi, lo, ps in zip(times, pad(wc), pad(tmax), pad(tmin), pad(psum)):
         daily_list.append({
             "date": date,
-            "desc": desc,
-            "max": tmax[i] if i < len(tmax) else None,
-            "min": tmin[i] if i < len(tmin) else None,
-            "precipitation_sum": psum[i] if i < len(psum) else None,
+            "desc": code_desc(code),
+            "max": hi,
+            "min": lo,
+            "precipitation_sum": ps,
         })
 
-    hourly_list: list[dict] = []
+    hourly_list: list[HourForecast] = []
     h = data.get("hourly", {})
     h_times = h.get("time", []) or []
     h_temp = h.get("temperature_2m", []) or []
@@ -231,21 +576,12 @@ def fetch_open_meteo() -> tuple[list[dict], list[dict], dict]:
     h_wind = h.get("windspeed_10m", []) or []
     h_wd = h.get("winddirection_10m", []) or []
 
-    for i, t in enumerate(h_times):
-        code = h_code[i] if i < len(h_code) else None
-        label = WEATHER_CODE_MAP.get(code) if code is not None else None
-        hourly_list.append({
-            "time": t,
-            "temperature": h_temp[i] if i < len(h_temp) else None,
-            "humidity": h_humi[i] if i < len(h_humi) else None,
-            "weather_code": code,
-            "weather_short": label,
-            "weather_desc": label,
-            "precipitation": h_prec[i] if i < len(h_prec) else None,
-            "precipitation_probability": h_pp[i] if i < len(h_pp) else None,
-            "windspeed": h_wind[i] if i < len(h_wind) else None,
-            "winddir": h_wd[i] if i < len(h_wd) else None,
-        })
+    append = hourly_list.append
+    for t, temp, humi, code, prec, pp, wind, wd in zip(
+        h_times, pad(h_temp), pad(h_humi), pad(h_code), pad(h_prec), pad(h_pp), pad(h_wind), pad(h_wd)
+    ):
+        desc = code_desc(code)
+        append(HourForecast(t, hour_label(t), temp, humi, code, desc, desc, prec, pp, wind, wd))
 
     return daily_list, hourly_list, data
 
@@ -253,32 +589,41 @@ def fetch_open_meteo() -> tuple[list[dict], list[dict], dict]:
 # Fallback: OWM + OpenRouter (giữ nguyên như code gốc)
 # ============================================================
 
-def fetch_owm_and_map():
+# Async để bản cài đặt thật dùng HTTP_CLIENT mà không chặn event loop
+async def fetch_owm_and_map() -> tuple[list[dict], list[HourForecast], dict]:
     return [], [], {}
 
-def fetch_openrouter_and_map():
+async def fetch_openrouter_and_map() -> tuple[list[dict], list[HourForecast], dict]:
     return [], [], {}
 
 # ============================================================
 # Merge dữ liệu & chọn 4 giờ tới
 # ============================================================
 
-def merge_weather_and_hours(existing: Optional[dict] = None) -> dict:
-    existing = existing or {}
+# Key hour_k dựng sẵn: (hour_k, hour_k_temperature, hour_k_humidity, hour_k_weather_desc)
+_HOUR_KEYS: tuple[tuple[str, str, str, str], ...] = tuple(
+    (f"hour_{k}", f"hour_{k}_temperature", f"hour_{k}_humidity", f"hour_{k}_weather_desc")
+    for k in range(1, EXTENDED_HOURS + 1)
+)
+
+# Memo kết quả merge theo (danh sách hourly đang cache, giờ bắt đầu đã làm tròn):
+# trong cùng một giờ và cùng một lần fetch, kết quả merge không đổi
+_merge_memo: dict[str, Any] = {}
 
-    daily_list, hourly_list, raw = fetch_open_meteo()
+async def merge_weather_and_hours(now: Optional[datetime] = None) -> dict:
+    daily_list, hourly_list, raw = await fetch_open_meteo()
     source = "open-meteo" if hourly_list else None
 
     if not hourly_list:
-        d_owm, h_owm, raw_owm = fetch_owm_and_map()
+        # Hỏi song song cả hai nguồn dự phòng: độ trễ = max thay vì tổng; OWM vẫn được ưu tiên
+        (d_owm, h_owm, raw_owm), (d_or, h_or, raw_or) = await asyncio.gather(
+            fetch_owm_and_map(), fetch_openrouter_and_map()
+        )
         if h_owm:
             logger.info("Fallback to OWM data")
             daily_list, hourly_list, raw = d_owm, h_owm, raw_owm
             source = "owm"
-
-    if not hourly_list:
-        d_or, h_or, raw_or = fetch_openrouter_and_map()
-        if h_or:
+        elif h_or:
             logger.info("Fallback to OpenRouter data")
             daily_list, hourly_list, raw = d_or, h_or, raw_or
             source = "openrouter"
@@ -287,13 +632,19 @@ def merge_weather_and_hours(existing: Optional[dict] = None) -> dict:
         logger.error("No hourly weather data available from any provider")
         return {}
 
-    now = _now_local()
+    # auto_loop truyền sẵn thời điểm của tick để cả tick dùng chung một lần lấy giờ địa phương
+    now = now or _now_local()
     start_time = ceil_to_next_hour(now)
 
+    if _merge_memo.get("hourly") is hourly_list and _merge_memo.get("start_time") == start_time:
+        merged = dict(_merge_memo["merged"])
+        merged["meta_fetched_at"] = now.isoformat()
+        return merged
+
     today_iso = now.date().isoformat()
     tomorrow_iso = (now + timedelta(days=1)).date().isoformat()
-    today = next((d for d in daily_list if d.get("date") == today_iso), {})
-    tomorrow = next((d for d in daily_list if d.get("date") == tomorrow_iso), {})
+    today = _lookup_day(daily_list, today_iso, 0)
+    tomorrow = _lookup_day(daily_list, tomorrow_iso, 1)
 
     merged: dict[str, Any] = {}
     if today:
@@ -305,75 +656,72 @@ def merge_weather_and_hours(existing: Optional[dict] = None) -> dict:
         merged["weather_tomorrow_max"] = tomorrow.get("max")
         merged["weather_tomorrow_min"] = tomorrow.get("min")
 
-    parsed_times: List[Optional[datetime]] = [_to_local_dt(h.get("time")) for h in hourly_list]
-
-    start_idx = None
-    for i, p in enumerate(parsed_times):
-        if p is None:
-            continue
-        s_comp = start_time
-        p_comp = p
-        if p_comp.tzinfo is None and s_comp.tzinfo is not None:
-            p_comp = p_comp.replace(tzinfo=s_comp.tzinfo)
-        if s_comp.tzinfo is None and p_comp.tzinfo is not None:
-            s_comp = s_comp.replace(tzinfo=p_comp.tzinfo)
-        if p_comp >= s_comp:
-            start_idx = i
-            break
-    if start_idx is None:
-        start_idx = 0
-
-    selected = []
-    for offset in range(EXTENDED_HOURS):
-        i = start_idx + offset
-        if i >= len(hourly_list):
-            break
-        selected.append(hourly_list[i])
-
-    for k, item in enumerate(selected, start=1):
-        dt_local = _to_local_dt(item.get("time"))
-        label = dt_local.strftime("%H:%M") if dt_local else item.get("time")
-        merged[f"hour_{k}"] = label
-        if item.get("temperature") is not None:
-            merged[f"hour_{k}_temperature"] = item.get("temperature")
-        if item.get("humidity") is not None:
-            merged[f"hour_{k}_humidity"] = item.get("humidity")
-        wlabel = item.get("weather_short") or item.get("weather_desc")
-        merged[f"hour_{k}_weather_desc"] = wlabel
+    start_idx = _find_hour_index(hourly_list, start_time)
 
-    merged["temperature_h"] = merged.get("hour_1_temperature")
-    merged["humidity"] = merged.get("hour_1_humidity")
+    selected = hourly_list[start_idx:start_idx + EXTENDED_HOURS]
 
-    hums = [h.get("humidity") for h in hourly_list if isinstance(h.get("humidity"), (int, float))]
-    if len(hums) >= 24:
-        merged["humidity_today"] = round(sum(hums[:24]) / 24.0, 1)
-    if len(hums) >= 48:
-        merged["humidity_tomorrow"] = round(sum(hums[24:48]) / 24.0, 1)
+    for (k_label, k_temp, k_humi, k_desc), item in zip(_HOUR_KEYS, selected):
+        merged[k_label] = item.label
+        merged[k_temp] = item.temperature
+        merged[k_humi] = item.humidity
+        merged[k_desc] = item.weather_short or item.weather_desc
+    # Thiếu giờ ở cuối dữ liệu: các slot còn lại ghi None một lượt, vòng chính không cần rẽ nhánh
+    for keys in _HOUR_KEYS[len(selected):]:
+        merged.update(dict.fromkeys(keys))
 
-    merged["location"] = "Dĩ An, Bình Dương"
-    merged["latitude"] = LAT
-    merged["longitude"] = LON
-    merged["meta_fetched_at"] = _now_local().isoformat()
-    merged["meta_provider"] = source
+    merged["temperature_h"] = merged.get("hour_1_temperature")
+    merged["humidity"] = merged.get("hour_1_humidity")
 
-    logger.info(f"merge done. provider={source}, start_time={start_time.isoformat()}, hour_keys={[f'hour_{i}' for i in range(1, len(selected)+1)]}")
+    # Một lượt duyệt: cộng dồn độ ẩm cho 2 cửa sổ 24h (hôm nay, ngày mai), không tạo list trung gian
+    hum_sums = [0.0, 0.0]
+    n_hums = 0
+    for h in hourly_list:
+        v = h.humidity
+        if isinstance(v, (int, float)):
+            hum_sums[n_hums // 24] += v
+            n_hums += 1
+            if n_hums == 48:
+                break
+    if n_hums >= 24:
+        merged["humidity_today"] = round(hum_sums[0] / 24.0, 1)
+    if n_hums >= 48:
+        merged["humidity_tomorrow"] = round(hum_sums[1] / 24.0, 1)
+
+    merged.update(
+        location=LOCATION_NAME,
+        latitude=LAT,
+        longitude=LON,
+        meta_fetched_at=now.isoformat(),
+        meta_provider=source,
+    )
+
+    _merge_memo.update(hourly=hourly_list, start_time=start_time, merged=dict(merged))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "merge done. provider=%s, start_time=%s, hour_keys=%s",
+            source, start_time.isoformat(), [keys[0] for keys in _HOUR_KEYS[:len(selected)]],
+        )
     return merged
 
 # ============================================================
 # Bias (tùy chọn)
 # ============================================================
 
+# Hiện chưa có caller: chưa có luồng nào đưa nhiệt độ đo được vào đây, nên bias_history/DB chưa nhận mẫu
 def update_bias_and_correct(selected_first: Optional[dict], observed_temp: Optional[float]) -> float:
     if not selected_first or observed_temp is None:
         return 0.0
     api_now = selected_first.get("temperature")
     try:
-        bias_history.append((api_now, observed_temp))
-        insert_history_to_db(api_now, observed_temp, provider="sensor")
+        # Ép kiểu một lần, dùng chung cho ring buffer và hàng đợi ghi DB
+        api_f = None if api_now is None else float(api_now)
+        obs_f = float(observed_temp)
+        bias_history.append(api_f, obs_f)
+        insert_history_to_db(api_f, obs_f, provider="sensor")
     except Exception:
         pass
-    diffs = [obs - api for api, obs in bias_history if api is not None and obs is not None]
-    return round(sum(diffs) / len(diffs), 1) if diffs else 0.0
+    mean = bias_history.mean_diff()
+    return round(mean, 1) if mean is not None else 0.0
 
 # ============================================================
 # ThingsBoard payload
@@ -384,51 +732,48 @@ LATEST_SENSOR: dict[str, Optional[float]] = {
     "avg_soil_moisture": None,
 }
 
+# Khung payload dashboard (key TB -> key trong merged) được dựng một lần lúc import
+_DASHBOARD_FIELDS: tuple[tuple[str, str], ...] = (
+    ("location", "location"),
+    ("latitude", "latitude"),
+    ("longitude", "longitude"),
+    ("temperature_h", "hour_1_temperature"),
+    ("humidity", "hour_1_humidity"),
+    *((key, key) for keys in _HOUR_KEYS for key in keys),
+    ("weather_tomorrow_min", "weather_tomorrow_min"),
+    ("weather_tomorrow_max", "weather_tomorrow_max"),
+    ("weather_tomorrow_desc", "weather_tomorrow_desc"),
+    ("humidity_tomorrow", "humidity_tomorrow"),
+)
+
 def build_dashboard_payload(merged: dict) -> dict:
-    payload = {
-        "location": merged.get("location"),
-        "latitude": merged.get("latitude"),
-        "longitude": merged.get("longitude"),
-        "temperature_h": merged.get("hour_1_temperature"),
-        "humidity": merged.get("hour_1_humidity"),
-        "hour_1": merged.get("hour_1"),
-        "hour_1_temperature": merged.get("hour_1_temperature"),
-        "hour_1_humidity": merged.get("hour_1_humidity"),
-        "hour_1_weather_desc": merged.get("hour_1_weather_desc"),
-        "hour_2": merged.get("hour_2"),
-        "hour_2_temperature": merged.get("hour_2_temperature"),
-        "hour_2_humidity": merged.get("hour_2_humidity"),
-        "hour_2_weather_desc": merged.get("hour_2_weather_desc"),
-        "hour_3": merged.get("hour_3"),
-        "hour_3_temperature": merged.get("hour_3_temperature"),
-        "hour_3_humidity": merged.get("hour_3_humidity"),
-        "hour_3_weather_desc": merged.get("hour_3_weather_desc"),
-        "hour_4": merged.get("hour_4"),
-        "hour_4_temperature": merged.get("hour_4_temperature"),
-        "hour_4_humidity": merged.get("hour_4_humidity"),
-        "hour_4_weather_desc": merged.get("hour_4_weather_desc"),
-        "weather_tomorrow_min": merged.get("weather_tomorrow_min"),
-        "weather_tomorrow_max": merged.get("weather_tomorrow_max"),
-        "weather_tomorrow_desc": merged.get("weather_tomorrow_desc"),
-        "humidity_tomorrow": merged.get("humidity_tomorrow"),
-        "illuminance": LATEST_SENSOR.get("illuminance"),
-        "avg_soil_moisture": LATEST_SENSOR.get("avg_soil_moisture"),
-    }
+    get = merged.get
+    payload = {key: get(src) for key, src in _DASHBOARD_FIELDS}
+    payload["illuminance"] = LATEST_SENSOR.get("illuminance")
+    payload["avg_soil_moisture"] = LATEST_SENSOR.get("avg_soil_moisture")
     return payload
-BANNED_KEYS = {"battery", "crop", "next_hours"}
+BANNED_KEYS = frozenset(("battery", "crop", "next_hours"))  # hằng: duyệt trực tiếp, không cần copy
 
-def send_to_thingsboard(payload: dict) -> Optional[requests.Response]:
+async def send_to_thingsboard(payload: dict | list[dict]) -> Optional[httpx.Response]:
     if not TB_DEVICE_URL:
         return None
     try:
-        r = requests.post(TB_DEVICE_URL, json=payload, timeout=10)
+        r = await _request_with_retry(
+            "POST",
+            TB_DEVICE_URL,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=10,
+        )
         if r.status_code != 200:
-            logger.warning(f"TB push returned {r.status_code} {r.text}")
+            logger.warning("TB push returned %s %s", r.status_code, r.text)
+        elif isinstance(payload, list):
+            logger.info("TB push OK. batch=%s", len(payload))
         else:
-            logger.info(f"TB push OK. keys={list(payload.keys())}")
+            logger.info("TB push OK. keys=%s", list(payload.keys()))
         return r
     except Exception as e:
-        logger.error(f"TB push exception: {e}")
+        logger.error("TB push exception: %s", e)
         return None
 
 # ============================================================
@@ -437,56 +782,118 @@ def send_to_thingsboard(payload: dict) -> Optional[requests.Response]:
 
 LAST_PUSH_TS: Optional[datetime] = None
 
+# Buffer telemetry: mỗi phần tử có dạng {"ts": ms, "values": payload} (định dạng mảng của TB)
+_tb_buffer: deque[dict] = deque(maxlen=TB_BUFFER_MAX)
+_tb_flush_event = asyncio.Event()
+_tb_fail_count = 0
+_tb_open_until = 0.0   # circuit breaker: không gửi TB trước thời điểm này
+
+# Đưa telemetry vào buffer mà không chờ ACK; tb_flush_loop sẽ gửi theo lô
+def enqueue_telemetry(payload: dict):
+    if not TB_DEVICE_URL:
+        return
+    _tb_buffer.append({"ts": int(time.time() * 1000), "values": payload})
+    if len(_tb_buffer) >= TB_BATCH_SIZE:
+        _tb_flush_event.set()
+
+def _requeue_telemetry(batch: list[dict]):
+    # Trả lô gửi lỗi về đầu buffer. Buffer có maxlen nên extendleft sẽ đẩy mẫu mới nhất (bên phải)
+    # ra ngoài: chỉ trả lại phần vừa chỗ trống, bỏ các mẫu cũ nhất của lô
+    room = TB_BUFFER_MAX - len(_tb_buffer)
+    dropped = len(batch) - max(room, 0)
+    if room > 0:
+        _tb_buffer.extendleft(reversed(batch[-room:]))
+    if dropped > 0:
+        logger.warning("[TB] buffer full, dropped %s oldest telemetry entries", dropped)
+
+async def flush_telemetry(force: bool = False):
+    # force=True (lần flush cuối khi shutdown): thử gửi cả khi breaker đang mở
+    global LAST_PUSH_TS, _tb_fail_count, _tb_open_until
+    if not _tb_buffer or (not force and time.time() < _tb_open_until):
+        return
+    batch = list(_tb_buffer)
+    _tb_buffer.clear()
+    try:
+        resp = await send_to_thingsboard(batch)
+    except asyncio.CancelledError:
+        # Bị huỷ giữa chừng (shutdown): trả lô về buffer để lần flush cuối gửi lại
+        _requeue_telemetry(batch)
+        raise
+    if resp and resp.status_code == 200:
+        LAST_PUSH_TS = datetime.now()
+        _tb_fail_count = 0
+        return
+    # Trả lô lại đầu buffer để lần flush sau gửi lại
+    _requeue_telemetry(batch)
+    _tb_fail_count += 1
+    if _tb_fail_count >= TB_BREAKER_THRESHOLD:
+        # Mỗi lần thử lại sau cooldown vẫn lỗi thì cooldown tăng gấp đôi (có jitter, có trần)
+        # Giới hạn số mũ: _tb_fail_count tăng mãi khi TB lỗi kéo dài, 2**n lớn sẽ gây OverflowError
+        cooldown = min(TB_BREAKER_COOLDOWN * 2 ** min(_tb_fail_count - TB_BREAKER_THRESHOLD, 10), TB_BREAKER_MAX_COOLDOWN)
+        cooldown *= random.uniform(0.8, 1.2)
+        _tb_open_until = time.time() + cooldown
+        logger.warning("[TB] %s consecutive failures, pausing pushes for %.0fs", _tb_fail_count, cooldown)
+
+async def tb_flush_loop():
+    logger.info("TB flusher started. batch=%s, interval=%ss", TB_BATCH_SIZE, TB_FLUSH_INTERVAL)
+    while True:
+        try:
+            await asyncio.wait_for(_tb_flush_event.wait(), timeout=TB_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _tb_flush_event.clear()
+        try:
+            await flush_telemetry()
+        except Exception as e:
+            logger.error("[TB FLUSH ERROR] %s", e)
+
 async def auto_loop():
-    global LAST_PUSH_TS
     logger.info("Auto-loop started")
     while True:
-        loop_start = datetime.now()
+        loop_start = _now_local()
         try:
-            merged = merge_weather_and_hours({})
+            merged = await merge_weather_and_hours(loop_start)
             merged.setdefault("forecast_bias", 0.0)
             merged.setdefault("forecast_history_len", len(bias_history))
             payload = build_dashboard_payload(merged)
-            for k in list(BANNED_KEYS):
+            for k in BANNED_KEYS:
                 payload.pop(k, None)
-            resp = send_to_thingsboard(payload)
-            if resp and resp.status_code == 200:
-                LAST_PUSH_TS = datetime.now()
+            enqueue_telemetry(payload)
         except Exception as e:
-            logger.error(f"[AUTO LOOP ERROR] {e}")
+            logger.error("[AUTO LOOP ERROR] %s", e)
         next_run = loop_start + timedelta(seconds=AUTO_LOOP_INTERVAL)
-        logger.info(f"[AUTO LOOP] Sleeping {AUTO_LOOP_INTERVAL}s, next run ≈ {next_run.isoformat()}")
+        logger.info("[AUTO LOOP] Sleeping %ss, next run ≈ %s", AUTO_LOOP_INTERVAL, next_run.isoformat())
         await asyncio.sleep(AUTO_LOOP_INTERVAL)
 
-def keep_alive_thread():
-    logger.info(f"Keep-alive thread started. Pinging {SELF_URL} every {KEEPALIVE_INTERVAL}s")
+async def keep_alive_loop():
+    logger.info("Keep-alive started. Pinging %s every %ss", SELF_URL, KEEPALIVE_INTERVAL)
     while True:
         try:
-            r = requests.get(SELF_URL, timeout=10)
-            logger.info(f"[KEEP-ALIVE] Ping {SELF_URL} -> {r.status_code}")
+            r = await HTTP_CLIENT.get(SELF_URL, timeout=10)
+            logger.info("[KEEP-ALIVE] Ping %s -> %s", SELF_URL, r.status_code)
         except Exception as e:
-            logger.warning(f"[KEEP-ALIVE ERROR] {e}")
-        time.sleep(KEEPALIVE_INTERVAL)
+            logger.warning("[KEEP-ALIVE ERROR] %s", e)
+        await asyncio.sleep(KEEPALIVE_INTERVAL)
 
 async def monitor_push():
-    global LAST_PUSH_TS
     CHECK_INTERVAL = 120
     MAX_GAP = AUTO_LOOP_INTERVAL * 2
+    if not TB_DEVICE_URL:
+        logger.info("[MONITOR] TB_DEVICE_URL not configured, push monitor disabled")
+        return
     while True:
         await asyncio.sleep(CHECK_INTERVAL)
         now = datetime.now()
         if LAST_PUSH_TS is None or (now - LAST_PUSH_TS).total_seconds() > MAX_GAP:
-            logger.warning(f"[MONITOR] Last push at {LAST_PUSH_TS}, retrying auto-loop immediately")
+            logger.warning("[MONITOR] Last push at %s, retrying auto-loop immediately", LAST_PUSH_TS)
             try:
-                merged = merge_weather_and_hours({})
+                merged = await merge_weather_and_hours()
                 payload = build_dashboard_payload(merged)
-                for k in list(BANNED_KEYS):
+                for k in BANNED_KEYS:
                     payload.pop(k, None)
-                resp = send_to_thingsboard(payload)
-                if resp and resp.status_code == 200:
-                    LAST_PUSH_TS = datetime.now()
+                enqueue_telemetry(payload)
             except Exception as e:
-                logger.error(f"[MONITOR] Retry push failed: {e}")
+                logger.error("[MONITOR] Retry push failed: %s", e)
 
 # ============================================================
 # FastAPI app
@@ -495,32 +902,69 @@ async def monitor_push():
 app = FastAPI(title="Agri-bot API Demo")
 
 class SensorData(BaseModel):
-    illuminance: Optional[float]
-    avg_soil_moisture: Optional[float]
+    model_config = ConfigDict(extra="ignore", frozen=True)  # ESP32 có thể gửi thêm field lạ: bỏ qua
+
+    illuminance: Optional[float] = None
+    avg_soil_moisture: Optional[float] = None
 
 @app.on_event("startup")
 async def on_startup():
+    global HTTP_CLIENT, _tb_flush_event
+    HTTP_CLIENT = _new_http_client()
+    # Event/task gắn với event loop cũ không dùng lại được ở lifespan mới
+    _tb_flush_event = asyncio.Event()
+    _weather_inflight.clear()
     init_db()
-    asyncio.create_task(auto_loop())
-    asyncio.create_task(monitor_push())
-    t = threading.Thread(target=keep_alive_thread, daemon=True)
-    t.start()
-    logger.info("Keep-alive thread launched.")
+    load_history_from_db()
+    load_weather_cache()
+    # Giữ handle các task nền để shutdown có thể dừng sạch (không rò task khi reload)
+    app.state.bg_tasks = [
+        asyncio.create_task(auto_loop()),
+        asyncio.create_task(monitor_push()),
+        asyncio.create_task(tb_flush_loop()),
+    ]
+    if SELF_URL:
+        app.state.bg_tasks.append(asyncio.create_task(keep_alive_loop()))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    global HTTP_CLIENT
+    tasks = getattr(app.state, "bg_tasks", [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await flush_telemetry(force=True)
+    except Exception as e:
+        logger.warning("Final TB flush failed: %s", e)
+    if _tb_buffer:
+        logger.warning("[TB] shutdown: dropping %s unsent telemetry entries", len(_tb_buffer))
+    flush_bias_history()
+    close_db()
+    save_weather_cache()
+    client, HTTP_CLIENT = HTTP_CLIENT, None
+    if client is not None:
+        await client.aclose()
 
 @app.get("/health")
 async def health():
     return {"status": "ok", "last_push": LAST_PUSH_TS.isoformat() if LAST_PUSH_TS else None}
 
 @app.get("/weather")
-async def weather():
-    return merge_weather_and_hours({})
+async def weather(response: Response):
+    now = _now_local()
+    merged = await merge_weather_and_hours(now)
+    # Client/proxy được cache /weather đến khi cache dự báo phía server hết hạn, nhưng không
+    # quá đầu giờ kế tiếp: hour_1..hour_4 tính từ ceil_to_next_hour(now) nên đổi theo giờ
+    entry = _weather_cache.get((LAT, LON))
+    max_age = int(entry["expires"] - time.time()) if entry else 0
+    max_age = min(max_age, 3600 - (now.minute * 60 + now.second))
+    response.headers["Cache-Control"] = f"max-age={max(0, max_age)}"
+    return merged
 
 @app.post("/sensor_update")
 async def sensor_update(data: SensorData):
-    if data.illuminance is not None:
-        LATEST_SENSOR["illuminance"] = data.illuminance
-    if data.avg_soil_moisture is not None:
-        LATEST_SENSOR["avg_soil_moisture"] = data.avg_soil_moisture
+    LATEST_SENSOR.update(data.model_dump(exclude_none=True))
     return {"status": "ok", "latest": LATEST_SENSOR}
 
 # ============================================================